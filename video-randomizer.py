@@ -1,20 +1,24 @@
 #!/usr/bin/python3
 
 import typing
-import cv2
+import concurrent.futures
 import os
 import math
 import argparse
+import functools
 import tempfile
 import hashlib
 import random
 import subprocess
+import threading
 import time
 import sys
 import shutil
 
 CWD = os.path.abspath(os.path.dirname(__file__))
 
+FFPROBE_BIN = ""
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -75,6 +79,13 @@ def parse_args() -> argparse.Namespace:
         default=False,
         help="dry mode, do not output video",
     )
+    parser.add_argument(
+        "-sp",
+        "--single-pass",
+        action="store_true",
+        default=False,
+        help="trim and concat samples in a single ffmpeg filter graph (no concat file)",
+    )
     parser.add_argument(
         "-q",
         "--quiet",
@@ -95,6 +106,25 @@ def parse_args() -> argparse.Namespace:
         default=23,
         help="libx264 Constant Rate Factor (default: 23)",
     )
+    parser.add_argument(
+        "--preset-build",
+        type=str,
+        default="veryfast",
+        help="libx264 preset for build conversions (default: veryfast)",
+    )
+    parser.add_argument(
+        "--preset-final",
+        type=str,
+        default="medium",
+        help="libx264 preset for the output encode (default: medium)",
+    )
+    parser.add_argument(
+        "--encoder",
+        type=str,
+        choices=["auto", "libx264", "h264_nvenc", "h264_qsv", "h264_vaapi"],
+        default="libx264",
+        help="h264 encoder, auto picks the first hardware encoder available (default: libx264)",
+    )
     parser.add_argument(
         "-r",
         "--seed",
@@ -122,6 +152,19 @@ def parse_args() -> argparse.Namespace:
         default=False,
         help="only keep video track",
     )
+    parser.add_argument(
+        "--no-copy",
+        action="store_true",
+        default=False,
+        help="re-encode the final video instead of stream-copying converted samples",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="parallel video conversions (default: 1)",
+    )
     parser.add_argument(
         "-ab",
         "--audio-bitrate",
@@ -136,35 +179,126 @@ def parse_args() -> argparse.Namespace:
 # === UTILS ===
 
 
+def prefetch_file_prefix(path: str) -> None:
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 1 << 20, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+_hash_buffers = threading.local()
+
+
 def get_file_hash(path: str) -> str:
-    with open(path, mode="rb") as f:
-        return hashlib.md5(f.read(8192)).hexdigest()
+    # one reusable buffer per hashing thread, no allocation per file
+    buffer = getattr(_hash_buffers, "buffer", None)
+    if buffer is None:
+        buffer = _hash_buffers.buffer = bytearray(1 << 20)
+    with open(path, "rb", buffering=0) as f:
+        n = f.readinto(buffer)
+    return hashlib.blake2b(memoryview(buffer)[:n]).hexdigest()[:32]
+
+
+def ffprobe_stream(
+    path: str, entries: str, streams: str = "v:0", count_packets: bool = False
+) -> str:
+    cmd = [FFPROBE_BIN or "ffprobe", "-v", "error", "-select_streams", streams]
+    if count_packets:
+        cmd += ["-count_packets"]
+    cmd += ["-show_entries", f"stream={entries}", "-of", "csv=p=0", path]
+    try:
+        result = subprocess.run(cmd, capture_output=True, universal_newlines=True)
+    except FileNotFoundError:
+        print("ffprobe not found on PATH")
+        sys.exit(1)
+    if result.returncode != 0:
+        return ""
+    return result.stdout.strip()
 
 
+@functools.lru_cache(maxsize=None)
 def get_video_frame_count(path: str) -> int:
-    return cv2.VideoCapture(path).get(cv2.CAP_PROP_FRAME_COUNT)
+    output = ffprobe_stream(path, "nb_frames")
+    if not output or output == "N/A":
+        output = ffprobe_stream(path, "nb_read_packets", count_packets=True)
+    if not output or output == "N/A":
+        return 0
+    return int(output)
+
+
+def write_frame_count(path: str) -> None:
+    with open(path + ".frames", "w") as f:
+        f.write(str(get_video_frame_count(path)))
+
+
+def load_frame_counts(videos: typing.List[str]) -> typing.Dict[str, int]:
+    framecounts = {}
+    for path in videos:
+        frames_path = path + ".frames"
+        if os.path.exists(frames_path):
+            with open(frames_path) as f:
+                try:
+                    framecounts[path] = int(f.read())
+                    continue
+                except ValueError:
+                    # empty or truncated sidecar from an interrupted run
+                    pass
+            write_frame_count(path)
+        framecounts[path] = get_video_frame_count(path)
+    return framecounts
+
+
+@functools.lru_cache(maxsize=None)
+def probe_framerate(path: str) -> typing.Optional[float]:
+    output = ffprobe_stream(path, "avg_frame_rate")
+    try:
+        num, den = output.split("/")
+        return int(num) / int(den)
+    except (ValueError, ZeroDivisionError):
+        return None
 
 
 def get_framerate(path: str, args: argparse.Namespace) -> float:
     if not args.no_convert:
         return args.framerate
-    return cv2.VideoCapture(path).get(cv2.CAP_PROP_FPS)
-
-
-def get_timestamp(frame_number: int, framerate: float) -> str:
-    t = frame_number / framerate
-    return f"{t//60:.0f}:{t%60:.3f}"
+    framerate = probe_framerate(path)
+    if framerate is None:
+        return args.framerate
+    return framerate
 
 
 def execute(cmd: typing.List[str], silent: bool = False) -> int:
-    out = subprocess.DEVNULL if silent else None
-    popen = subprocess.Popen(cmd, stdout=out, stderr=out, universal_newlines=True)
+    if silent:
+        popen = subprocess.Popen(
+            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        return popen.wait()
+    popen = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1 << 20
+    )
+    # flush anything printed through the text layer (like the command echo)
+    # before raw child output is interleaved on the same fd
+    sys.stdout.flush()
+    fd = popen.stdout.fileno()
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
     return popen.wait()
 
 
-def get_ffmpeg_bin(args: argparse.Namespace) -> str:
-    if args.ffmpeg and os.path.exists(args.ffmpeg):
-        return args.ffmpeg
+@functools.lru_cache(maxsize=None)
+def find_ffmpeg_bin(ffmpeg: str) -> str:
+    if ffmpeg and os.path.exists(ffmpeg):
+        return ffmpeg
     path = shutil.which("ffmpeg")
     if not path:
         print("ffmpeg not found on PATH")
@@ -172,6 +306,24 @@ def get_ffmpeg_bin(args: argparse.Namespace) -> str:
     return path
 
 
+def get_ffmpeg_bin(args: argparse.Namespace) -> str:
+    return find_ffmpeg_bin(args.ffmpeg)
+
+
+@functools.lru_cache(maxsize=None)
+def find_ffprobe_bin(ffmpeg_bin: str) -> str:
+    # ffprobe ships next to ffmpeg, so honor an --ffmpeg binary off PATH
+    directory, basename = os.path.split(ffmpeg_bin)
+    path = os.path.join(directory, basename.replace("ffmpeg", "ffprobe"))
+    if os.path.exists(path):
+        return path
+    path = shutil.which("ffprobe")
+    if not path:
+        print("ffprobe not found on PATH")
+        sys.exit(1)
+    return path
+
+
 def ffmpeg(parameters: typing.List[str], args: argparse.Namespace) -> bool:
     ffmpeg_bin = get_ffmpeg_bin(args)
     cmd = [ffmpeg_bin] + parameters
@@ -180,15 +332,61 @@ def ffmpeg(parameters: typing.List[str], args: argparse.Namespace) -> bool:
     return execute(cmd, args.quiet or args.quiet_ffmpeg) == 0
 
 
-def get_scale(args: argparse.Namespace) -> str:
-    if args.width is None and args.height is None:
+@functools.lru_cache(maxsize=None)
+def compute_scale(width: int, height: int) -> str:
+    if width is None and height is None:
         return "1920:1080"
-    elif args.height is None:
-        return f"{args.width}:{round(args.width * 9 / 16)}"
-    elif args.width is None:
-        return f"{round(args.height * 16 / 9)}:{args.height}"
+    elif height is None:
+        return f"{width}:{round(width * 9 / 16)}"
+    elif width is None:
+        return f"{round(height * 16 / 9)}:{height}"
     else:
-        return f"{args.width}:{args.height}"
+        return f"{width}:{height}"
+
+
+def get_scale(args: argparse.Namespace) -> str:
+    return compute_scale(args.width, args.height)
+
+
+HARDWARE_ENCODERS = ["h264_nvenc", "h264_qsv", "h264_vaapi"]
+
+
+@functools.lru_cache(maxsize=None)
+def find_hardware_encoder(ffmpeg_bin: str) -> str:
+    result = subprocess.run(
+        [ffmpeg_bin, "-hide_banner", "-encoders"],
+        capture_output=True,
+        universal_newlines=True,
+    )
+    if result.returncode != 0:
+        return "libx264"
+    for encoder in HARDWARE_ENCODERS:
+        if f" {encoder} " in result.stdout:
+            return encoder
+    return "libx264"
+
+
+def get_encoder(args: argparse.Namespace) -> str:
+    if args.encoder == "auto":
+        return find_hardware_encoder(get_ffmpeg_bin(args))
+    return args.encoder
+
+
+def encoder_parameters(
+    args: argparse.Namespace, preset: str, crf: int = None
+) -> typing.Tuple[typing.List[str], typing.List[str], str]:
+    encoder = get_encoder(args)
+    pre_input = []
+    codec = ["-c:v", encoder]
+    vf_suffix = ""
+    if encoder == "libx264":
+        codec += ["-preset", preset]
+        if crf is not None:
+            codec += ["-crf", str(crf)]
+    elif encoder == "h264_vaapi":
+        pre_input = ["-vaapi_device", "/dev/dri/renderD128"]
+        vf_suffix = ",format=nv12,hwupload"
+    return pre_input, codec, vf_suffix
 
 
 def no_convert(args: argparse.Namespace) -> bool:
@@ -199,12 +397,18 @@ def no_convert(args: argparse.Namespace) -> bool:
     return len(args.file) == 1
 
 
+def use_stream_copy(args: argparse.Namespace) -> bool:
+    return not args.no_convert and not args.no_copy and not args.single_pass
+
+
 # === MAIN ===
 
 
 def fix_arguments(args: argparse.Namespace) -> argparse.Namespace:
+    global FFPROBE_BIN
     args.no_convert = no_convert(args)
     args.framerate = args.framerate if args.framerate is not None else 30
+    FFPROBE_BIN = find_ffprobe_bin(get_ffmpeg_bin(args))
     return args
 
 
@@ -223,22 +427,21 @@ def get_build_dir(args: argparse.Namespace) -> str:
     return path
 
 
-def convert_video(in_path: str, out_path: str, args: argparse.Namespace) -> bool:
-    parameters = [
-        "-y",
-        "-f",
-        "mp4",
-        "-i",
-        in_path,
-        "-c:v",
-        "libx264",
+def convert_video(
+    in_path: str, out_path: str, args: argparse.Namespace, threads: int = None
+) -> bool:
+    pre_input, codec, vf_suffix = encoder_parameters(args, args.preset_build, args.crf)
+    parameters = ["-y"] + pre_input + ["-f", "mp4", "-i", in_path] + codec
+    parameters += [
         "-vf",
-        f"scale={get_scale(args)},fps={args.framerate}",
-        "-crf",
-        str(args.crf),
+        f"scale={get_scale(args)},fps={args.framerate}{vf_suffix}",
         "-video_track_timescale",
         "90000",
+        "-force_key_frames",
+        f"expr:gte(t,n_forced*{args.sample})",
     ]
+    if threads is not None:
+        parameters += ["-threads", str(threads)]
     if args.no_audio:
         parameters += ["-an"]
     else:
@@ -247,86 +450,252 @@ def convert_video(in_path: str, out_path: str, args: argparse.Namespace) -> bool
     return ffmpeg(parameters, args)
 
 
+def video_matches_target(path: str, args: argparse.Namespace) -> bool:
+    output = ffprobe_stream(path, "codec_name,width,height,avg_frame_rate")
+    try:
+        codec, width, height, framerate = output.split(",")
+        num, den = framerate.split("/")
+        fps = int(num) / int(den)
+    except (ValueError, ZeroDivisionError):
+        return False
+    if (
+        codec != "h264"
+        or f"{width}:{height}" != get_scale(args)
+        or abs(fps - args.framerate) > 0.001
+    ):
+        return False
+    audio = ffprobe_stream(path, "codec_name", streams="a:0")
+    if args.no_audio:
+        # a leftover audio track would leak into the concat output
+        return audio == ""
+    return audio == "aac"
+
+
+def convert_video_worker(
+    data: typing.Tuple[str, str, argparse.Namespace]
+) -> typing.Tuple[bool, str, str]:
+    in_path, out_path, args = data
+    threads = max(1, (os.cpu_count() or 1) // args.jobs)
+    result = convert_video(in_path, out_path, args, threads)
+    if result:
+        write_frame_count(out_path)
+    return result, in_path, out_path
+
+
 def convert_all_videos(build_dir: str, args: argparse.Namespace) -> typing.List[str]:
     converted = []
     to_convert = []
-    for path in args.file:
-        if os.path.exists(path):
-            if args.no_convert:
-                converted += [os.path.realpath(path)]
-            else:
-                output_path = os.path.join(build_dir, get_file_hash(path) + ".mp4")
-                if os.path.exists(output_path):
-                    converted += [output_path]
-                else:
+    paths = [path for path in args.file if os.path.exists(path)]
+    if args.no_convert:
+        converted = [os.path.realpath(path) for path in paths]
+    elif len(paths):
+        for path in paths:
+            prefetch_file_prefix(path)
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(32, len(paths))
+        ) as executor:
+            hashes = list(executor.map(get_file_hash, paths))
+        for path, file_hash in zip(paths, hashes):
+            output_path = os.path.join(build_dir, file_hash + ".mp4")
+            if os.path.exists(output_path):
+                converted += [output_path]
+                if os.path.islink(output_path):
+                    args.no_copy = True
+            elif video_matches_target(path, args):
+                # already at the target codec/scale/fps, a re-encode would
+                # only degrade quality
+                try:
+                    os.symlink(os.path.realpath(path), output_path)
+                except OSError:
+                    # symlinks can require elevated privileges on Windows,
+                    # fall back to a regular conversion
                     to_convert += [(path, output_path)]
+                else:
+                    write_frame_count(output_path)
+                    converted += [output_path]
+                    # the source lacks the per-sample forced keyframes, so the
+                    # final concat must re-encode instead of stream-copying
+                    args.no_copy = True
+            else:
+                to_convert += [(path, output_path)]
     if not args.quiet:
         print(f"Found {len(converted) + len(to_convert)} videos")
         print(f"{len(converted)} already converted")
     if len(to_convert):
         if not args.quiet:
             print(f"Converting {len(to_convert)} videos...")
-        for i, data in enumerate(to_convert):
-            in_path, out_path = data
-            result = convert_video(in_path, out_path, args)
-            if not args.quiet:
-                print(
-                    f"[{i + 1} / {len(to_convert)}] {'OK' if result else 'KO'} {in_path} -> {out_path}"
-                )
-            if result:
-                converted += [out_path]
+        tasks = [(in_path, out_path, args) for in_path, out_path in to_convert]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            for i, data in enumerate(executor.map(convert_video_worker, tasks)):
+                result, in_path, out_path = data
+                if not args.quiet:
+                    print(
+                        f"[{i + 1} / {len(to_convert)}] {'OK' if result else 'KO'} {in_path} -> {out_path}"
+                    )
+                if result:
+                    converted += [out_path]
     return converted
 
 
-def generate_concat_file(videos: typing.List[str], args: argparse.Namespace) -> str:
+def generate_samples(
+    videos: typing.List[str], args: argparse.Namespace
+) -> typing.List[typing.Tuple[str, int, int, float]]:
     random.seed(args.seed)
     if not args.quiet:
         print(f"Random seed: {args.seed}")
-    with tempfile.NamedTemporaryFile(delete=False) as tmp:
-        tmp.write("ffconcat version 1.0\n".encode())
-        t = 0
-        while t < args.duration:
-            file = random.choice(videos)
-            framecount = get_video_frame_count(file)
-            framerate = get_framerate(file, args)
-            if framecount > 0:
-                tmp.write(f"file '{file}'\n".encode())
-                inpoint = round(
-                    random.random() * framecount * (1 - args.ignore / 100.0 * 2)
-                )
-                tmp.write(
-                    f"inpoint {get_timestamp(inpoint, framerate)}\n".encode()
-                )
-                outpoint = inpoint + round(args.sample * framerate)
-                tmp.write(
-                    f"outpoint {get_timestamp(outpoint, framerate)}\n".encode()
-                )
-                t += args.sample
-        if not args.quiet:
-            print(f"FFMPEG concat file: {tmp.name}")
-        return tmp.name
+    framecounts = load_frame_counts(videos)
+    usable = [file for file in videos if framecounts[file] > 0]
+    count = math.ceil(args.duration / args.sample)
+    files = random.choices(usable, k=count) if usable else []
+    samples = []
+    copy_mode = use_stream_copy(args)
+    for file in files:
+        framecount = framecounts[file]
+        framerate = get_framerate(file, args)
+        sample_frames = round(args.sample * framerate)
+        inpoint = round(random.random() * framecount * (1 - args.ignore / 100.0 * 2))
+        if copy_mode and sample_frames > 0:
+            # stream copy cannot drop packets before the in point, so cuts
+            # must land on the keyframes forced every --sample seconds
+            inpoint -= inpoint % sample_frames
+        outpoint = inpoint + sample_frames
+        samples += [(file, inpoint, outpoint, framerate)]
+    return samples
+
+
+def build_concat_payload(
+    samples: typing.List[typing.Tuple[str, int, int, float]]
+) -> bytes:
+    lines = ["ffconcat version 1.0"]
+    for file, inpoint, outpoint, framerate in samples:
+        spf = 1.0 / framerate
+        lines += [
+            f"file '{file}'",
+            f"inpoint {inpoint * spf:.3f}",
+            f"outpoint {outpoint * spf:.3f}",
+        ]
+    return ("\n".join(lines) + "\n").encode()
+
+
+def generate_concat_file(
+    samples: typing.List[typing.Tuple[str, int, int, float]],
+    args: argparse.Namespace,
+) -> str:
+    fd, path = tempfile.mkstemp()
+    os.write(fd, build_concat_payload(samples))
+    os.close(fd)
+    if not args.quiet:
+        print(f"FFMPEG concat file: {path}")
+    return path
 
 
 def make_output_video(
     concat_file: str, output_file: str, args: argparse.Namespace
 ) -> None:
-    parameters = [
-        "-y",
-        "-f",
-        "concat",
-        "-safe",
-        "0",
-        "-i",
-        concat_file,
-        "-c:v",
-        "libx264",
-        "-async",
-        "1"
-    ]
+    copy_mode = use_stream_copy(args)
+    if copy_mode:
+        # build files share codec, scale, fps and timescale, so the concat
+        # demuxer can stream-copy without a second encode
+        pre_input, codec, vf_suffix = [], ["-c", "copy"], ""
+    else:
+        pre_input, codec, vf_suffix = encoder_parameters(args, args.preset_final)
+    parameters = ["-y"] + pre_input + ["-f", "concat", "-safe", "0", "-i", concat_file]
+    parameters += codec
+    if vf_suffix:
+        parameters += ["-vf", vf_suffix.lstrip(",")]
+    if copy_mode:
+        if args.no_audio:
+            parameters += ["-an"]
+    else:
+        parameters += ["-async", "1"]
+        if args.no_audio:
+            parameters += ["-an"]
+        else:
+            parameters += ["-c:a", "aac", "-b:a", f"{args.audio_bitrate}k"]
+    parameters += [output_file]
+    if not ffmpeg(parameters, args):
+        sys.exit(1)
+
+
+def write_fifo(path: str, payload: bytes) -> None:
+    try:
+        with open(path, "wb") as fifo:
+            fifo.write(payload)
+    except OSError:
+        # ffmpeg exited before reading the whole list, it already reported why
+        pass
+
+
+def stream_output_video(
+    samples: typing.List[typing.Tuple[str, int, int, float]],
+    output_file: str,
+    args: argparse.Namespace,
+) -> None:
+    if not hasattr(os, "mkfifo"):
+        make_output_video(generate_concat_file(samples, args), output_file, args)
+        return
+    payload = build_concat_payload(samples)
+    fifo_dir = tempfile.mkdtemp()
+    fifo_path = os.path.join(fifo_dir, "concat.ffconcat")
+    os.mkfifo(fifo_path)
+    # the writer blocks until ffmpeg opens the read end, so ffmpeg starts
+    # consuming entries while its decoders are still initializing
+    writer = threading.Thread(target=write_fifo, args=(fifo_path, payload), daemon=True)
+    writer.start()
+    try:
+        make_output_video(fifo_path, output_file, args)
+    finally:
+        writer.join(timeout=1)
+        shutil.rmtree(fifo_dir, ignore_errors=True)
+
+
+def make_output_video_single_pass(
+    samples: typing.List[typing.Tuple[str, int, int, float]],
+    output_file: str,
+    args: argparse.Namespace,
+) -> None:
+    inputs = []
+    indexes = {}
+    filters = []
+    pads = ""
+    for i, data in enumerate(samples):
+        file, inpoint, outpoint, framerate = data
+        if file not in indexes:
+            indexes[file] = len(inputs)
+            inputs += [file]
+        n = indexes[file]
+        start = inpoint / framerate
+        end = outpoint / framerate
+        filters += [
+            f"[{n}:v]trim=start={start:.3f}:end={end:.3f},setpts=PTS-STARTPTS[v{i}]"
+        ]
+        pads += f"[v{i}]"
+        if not args.no_audio:
+            filters += [
+                f"[{n}:a]atrim=start={start:.3f}:end={end:.3f},asetpts=PTS-STARTPTS[a{i}]"
+            ]
+            pads += f"[a{i}]"
     if args.no_audio:
-        parameters += ["-an"]
+        filters += [f"{pads}concat=n={len(samples)}:v=1[outv]"]
     else:
-        parameters += ["-c:a", "aac", "-b:a", f"{args.audio_bitrate}k"]
+        filters += [f"{pads}concat=n={len(samples)}:v=1:a=1[outv][outa]"]
+    pre_input, codec, vf_suffix = encoder_parameters(args, args.preset_final)
+    out_pad = "[outv]"
+    if vf_suffix:
+        filters += [f"[outv]{vf_suffix.lstrip(',')}[outhw]"]
+        out_pad = "[outhw]"
+    parameters = ["-y"] + pre_input
+    for file in inputs:
+        parameters += ["-i", file]
+    parameters += [
+        "-filter_complex",
+        ";".join(filters),
+        "-map",
+        out_pad,
+    ]
+    parameters += codec
+    if not args.no_audio:
+        parameters += ["-map", "[outa]", "-c:a", "aac", "-b:a", f"{args.audio_bitrate}k"]
     parameters += [output_file]
     if not ffmpeg(parameters, args):
         sys.exit(1)
@@ -343,7 +712,12 @@ if __name__ == "__main__":
 
     videos = convert_all_videos(build_dir, args)
 
-    concat_file = generate_concat_file(videos, args)
+    samples = generate_samples(videos, args)
 
-    if not args.dry:
-        make_output_video(concat_file, output_file, args)
+    if args.single_pass:
+        if not args.dry:
+            make_output_video_single_pass(samples, output_file, args)
+    elif args.dry:
+        generate_concat_file(samples, args)
+    else:
+        stream_output_video(samples, output_file, args)